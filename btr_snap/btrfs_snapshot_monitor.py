@@ -18,21 +18,99 @@ Configuration:
 """
 
 import os
+import errno
 import sys
 import time
 import subprocess
 import logging
+import logging.handlers
+import select
+import signal
+import stat
 import argparse
+import atexit
+import bisect
+import concurrent.futures
 import json
+import queue
+import re
+import ctypes
+import fcntl
+from collections import defaultdict
 from datetime import datetime, timedelta
-from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 import hashlib
 
+try:
+    import btrfsutil
+except ImportError:
+    btrfsutil = None
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+class _BtrfsIoctlTimespec(ctypes.Structure):
+    _fields_ = [('sec', ctypes.c_uint64), ('nsec', ctypes.c_uint32)]
+
+
+class _BtrfsIoctlGetSubvolInfoArgs(ctypes.Structure):
+    """struct btrfs_ioctl_get_subvol_info_args from linux/btrfs.h"""
+    _fields_ = [
+        ('treeid', ctypes.c_uint64),
+        ('name', ctypes.c_char * 256),
+        ('parent_id', ctypes.c_uint64),
+        ('dirid', ctypes.c_uint64),
+        ('generation', ctypes.c_uint64),
+        ('flags', ctypes.c_uint64),
+        ('uuid', ctypes.c_uint8 * 16),
+        ('parent_uuid', ctypes.c_uint8 * 16),
+        ('received_uuid', ctypes.c_uint8 * 16),
+        ('ctransid', ctypes.c_uint64),
+        ('otransid', ctypes.c_uint64),
+        ('stransid', ctypes.c_uint64),
+        ('rtransid', ctypes.c_uint64),
+        ('ctime', _BtrfsIoctlTimespec),
+        ('otime', _BtrfsIoctlTimespec),
+        ('stime', _BtrfsIoctlTimespec),
+        ('rtime', _BtrfsIoctlTimespec),
+        ('reserved', ctypes.c_uint64 * 8),
+    ]
+
+
+# _IOR(BTRFS_IOCTL_MAGIC, 60, struct btrfs_ioctl_get_subvol_info_args), kernel >= 4.18
+BTRFS_IOC_GET_SUBVOL_INFO = (
+    (2 << 30) | (ctypes.sizeof(_BtrfsIoctlGetSubvolInfoArgs) << 16) | (0x94 << 8) | 60
+)
+
+
+# From linux/prctl.h
+PR_SET_TIMERSLACK = 29
+
+
+# Fixed offsets into snapshot names (YYYYMMDD_HHMMSS_TYPE)
+_YEAR = slice(0, 4)
+_MONTH = slice(0, 6)
+_DAY = slice(0, 8)
+_HOUR = slice(0, 11)
+_TYPE = slice(16, None)
+
+
+def _get_generation_ioctl(fd: int) -> int:
+    """Read the generation of the subvolume open on fd with one ioctl"""
+    args = _BtrfsIoctlGetSubvolInfoArgs()
+    fcntl.ioctl(fd, BTRFS_IOC_GET_SUBVOL_INFO, args)
+    return args.generation
+
 
 class BTRFSSnapshotMonitor:
     """BTRFS Snapshot Monitor with automatic cleanup"""
     
+    # Maximum number of subvolumes passed to one 'btrfs subvolume delete'
+    DELETE_BATCH_SIZE = 64
+    
     def __init__(self, config: Dict):
         self.config = config
         self.source_subvolume = config.get('source_subvolume', '/btrfs/home')
@@ -40,8 +118,15 @@ class BTRFSSnapshotMonitor:
         self.check_interval = config.get('check_interval', 300)  # 5 minutes
         self.max_snapshots_per_type = config.get('max_snapshots_per_type', 30)
         self.snapshot_types = ['MINUTE', 'HOUR', 'DAY', 'MONTH', 'YEAR']
+        self._snapshot_name_re = re.compile(
+            r'\d{8}_\d{6}_(' + '|'.join(self.snapshot_types) + ')'
+        )
         self.test_mode = config.get('test_mode', False)
         self.fake_time = config.get('fake_time', None)  # datetime object for test mode
+        self.stat_precheck = config.get('stat_precheck', False)
+        self.min_minute_interval = timedelta(seconds=config.get('min_minute_interval', 60))
+        self.inotify_debounce = config.get('inotify_debounce', 5)
+        self.cpu_pin = config.get('cpu_pin', False)
         
         # Setup logging
         self.setup_logging()
@@ -49,49 +134,158 @@ class BTRFSSnapshotMonitor:
         # Ensure directories exist
         self.ensure_directories()
         
-        # Initialize last snapshot hash
+        # Keep the source subvolume open for generation ioctls
+        self._subvol_fd: Optional[int] = None
+        if not self.test_mode:
+            try:
+                self._subvol_fd = os.open(self.source_subvolume, os.O_RDONLY | os.O_DIRECTORY)
+            except OSError as e:
+                self.logger.warning(f"Failed to open {self.source_subvolume}: {e}")
+        
+        # Record the starting state so has_changes() only has to compare
         self.last_snapshot_hash = None
+        if not self.test_mode:
+            self.last_snapshot_hash = self.get_subvolume_hash(self.source_subvolume)
+        
+        # Set when a change was seen but its snapshot was postponed
+        self._change_deferred = False
+        
+        # Set when wait_for_next_check() woke on inotify events
+        self._events_seen = False
+        
+        # Time of the last snapshot created per type
+        self._last_type_ts: Dict[str, datetime] = {}
+        
+        # (ctime_ns, mtime_ns) of the subvolume root at the last check
+        self._last_stat: Optional[Tuple[int, int]] = None
+        
+        # inotify watches on the source subvolume tree, set up by monitor_loop()
+        self._inotify = None
+        self._epoll = None
+        self._watch_paths: Dict[int, str] = {}
+        # Cap on watches (max_watches) and whether it or the kernel limit was
+        # hit; once exhausted no further watches are tried
+        self._max_watches = 0
+        self._watches_exhausted = False
+        
+        # Cached snapshot listing (sorted per type), keyed on the snapshot
+        # directory mtime
+        self._snapshots_cache: Optional[Dict[str, List[str]]] = None
+        self._snapshots_cache_mtime = None
+        
+        # Old snapshots are deleted in the background; names in flight are tracked
+        # so they are not scheduled twice. Results are applied on the main
+        # thread by reap_deletions(), so only it touches the cache.
+        self._delete_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.get('delete_threads', 2)
+        )
+        self._pending_deletes: Set[str] = set()
+        self._delete_futures: Dict[concurrent.futures.Future, List[str]] = {}
+        
+        # Read the snapshot directory once; later ticks update the cache in place
+        self.get_existing_snapshots()
         
     def setup_logging(self):
         """Setup logging configuration"""
         log_level = self.config.get('log_level', 'INFO')
         log_file = self.config.get('log_file', '/var/log/btrfs_snapshot_monitor.log')
-        
-        logging.basicConfig(
-            level=getattr(logging, log_level.upper()),
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(log_file),
-                logging.StreamHandler(sys.stdout)
-            ]
+        level = getattr(logging, log_level.upper())
+        log_format = '%(asctime)s - %(levelname)s - %(message)s'
+        
+        # Buffer file output; errors and shutdown (logging's atexit hook)
+        # flush the buffer
+        file_handler = logging.FileHandler(log_file)
+        file_handler.setFormatter(logging.Formatter(log_format))
+        buffered_handler = logging.handlers.MemoryHandler(
+            capacity=256,
+            flushLevel=logging.ERROR,
+            target=file_handler
         )
+        buffered_handler.setLevel(level)
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(logging.Formatter(log_format))
+        
+        # Callers only enqueue records; a listener thread does the writes.
+        # Its atexit hook is registered after logging's own, so it drains
+        # the queue before logging.shutdown() flushes the file buffer.
+        log_queue = queue.SimpleQueue()
+        self._log_listener = logging.handlers.QueueListener(
+            log_queue, buffered_handler, stream_handler,
+            respect_handler_level=True
+        )
+        self._log_listener.start()
+        atexit.register(self._log_listener.stop)
+        
+        # Records don't use process or thread fields; skip looking them up
+        logging.logProcesses = False
+        logging.logThreads = False
+        
+        root_logger = logging.getLogger()
+        root_logger.setLevel(level)
+        root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
         self.logger = logging.getLogger(__name__)
         
     def ensure_directories(self):
         """Ensure required directories exist"""
-        Path(self.snapshot_dir).mkdir(parents=True, exist_ok=True)
+        # A single stat on the usual path where the directory already exists
+        try:
+            st = os.stat(self.snapshot_dir)
+            if not stat.S_ISDIR(st.st_mode):
+                raise NotADirectoryError(f"Snapshot path is not a directory: {self.snapshot_dir}")
+        except FileNotFoundError:
+            os.makedirs(self.snapshot_dir)
+        # Snapshot paths are built by concatenation with this prefix
+        self._snap_prefix = os.path.join(os.fspath(self.snapshot_dir), '')
         self.logger.info(f"Ensured snapshot directory exists: {self.snapshot_dir}")
         
-    def run_command(self, command: List[str], check: bool = True) -> subprocess.CompletedProcess:
-        """Run a shell command and return the result"""
+    def run_command(self, command: List[str], check: bool = True,
+                    capture: bool = False) -> subprocess.CompletedProcess:
+        """Run a shell command and return the result
+        
+        Output is only captured and decoded when capture is True; otherwise
+        stdout is discarded and stderr is kept for error reporting.
+        """
+        if capture:
+            output = {'capture_output': True, 'text': True}
+        else:
+            output = {'stdout': subprocess.DEVNULL, 'stderr': subprocess.PIPE}
+            
         try:
             result = subprocess.run(
                 command,
-                capture_output=True,
-                text=True,
-                check=check
+                check=check,
+                **output
             )
             return result
         except subprocess.CalledProcessError as e:
+            stderr = e.stderr
+            if isinstance(stderr, bytes):
+                stderr = stderr.decode(errors='replace')
             self.logger.error(f"Command failed: {' '.join(command)}")
-            self.logger.error(f"Error: {e.stderr}")
+            self.logger.error(f"Error: {stderr}")
             raise
             
     def get_subvolume_hash(self, subvolume_path: str) -> str:
         """Get a hash representing the current state of the subvolume"""
+        if self._subvol_fd is not None and subvolume_path == self.source_subvolume:
+            try:
+                return str(_get_generation_ioctl(self._subvol_fd))
+            except OSError as e:
+                # Not btrfs or an old kernel: stop trying and use the fallbacks
+                self.logger.warning(f"GET_SUBVOL_INFO ioctl failed, falling back: {e}")
+                os.close(self._subvol_fd)
+                self._subvol_fd = None
+                
+        if btrfsutil is not None:
+            try:
+                # Single ioctl instead of spawning the btrfs CLI
+                return str(btrfsutil.subvolume_info(subvolume_path).generation)
+            except btrfsutil.BtrfsUtilError as e:
+                self.logger.warning(f"btrfsutil lookup failed, falling back to btrfs CLI: {e}")
+                
         try:
             # Use btrfs subvolume show to get generation number and other metadata
-            result = self.run_command(['btrfs', 'subvolume', 'show', subvolume_path])
+            result = self.run_command(['btrfs', 'subvolume', 'show', subvolume_path], capture=True)
             
             # Extract generation number from output
             for line in result.stdout.split('\n'):
@@ -114,18 +308,38 @@ class BTRFSSnapshotMonitor:
         if self.test_mode:
             return True
             
-        current_hash = self.get_subvolume_hash(self.source_subvolume)
-        
-        if self.last_snapshot_hash is None:
-            self.last_snapshot_hash = current_hash
-            return False
+        # A change postponed by get_snapshot_type() still needs its snapshot
+        deferred = self._change_deferred
+        self._change_deferred = False
+        
+        # The generation only moves when btrfs commits a transaction (every
+        # 30 s by default), so shortly after a burst of writes it can still
+        # look unchanged. Trust inotify instead; the snapshot itself commits
+        # the pending transaction.
+        if self._events_seen:
+            self._events_seen = False
+            self.logger.info(f"Changes detected in {self.source_subvolume} (inotify)")
+            return True
+            
+        # Skip the btrfs call entirely if the subvolume root looks untouched.
+        # Only changes to the top-level directory are visible this way.
+        if self.stat_precheck and not deferred:
+            try:
+                st = os.stat(self.source_subvolume)
+                current_stat = (st.st_ctime_ns, st.st_mtime_ns)
+                if current_stat == self._last_stat:
+                    return False
+                self._last_stat = current_stat
+            except OSError as e:
+                self.logger.warning(f"Failed to stat {self.source_subvolume}: {e}")
             
+        current_hash = self.get_subvolume_hash(self.source_subvolume)
         has_changes = current_hash != self.last_snapshot_hash
         if has_changes:
             self.logger.info(f"Changes detected in {self.source_subvolume}")
             self.last_snapshot_hash = current_hash
             
-        return has_changes
+        return has_changes or deferred
         
     def get_current_time(self) -> datetime:
         """Get current time, using fake_time in test mode"""
@@ -133,70 +347,94 @@ class BTRFSSnapshotMonitor:
             return self.fake_time
         return datetime.now()
     
-    def get_snapshot_type(self) -> str:
-        """Determine the appropriate snapshot type based on current time"""
-        now = self.get_current_time()
+    def get_snapshot_type(self, now: Optional[datetime] = None,
+                          stamp: Optional[str] = None) -> Optional[str]:
+        """Determine the appropriate snapshot type based on current time
+        
+        stamp is now formatted as YYYYMMDD_HHMMSS; pass it to avoid
+        formatting the same instant again.
+        
+        Returns None if only a MINUTE snapshot is due but the previous one
+        is less than min_minute_interval old.
+        """
+        if now is None:
+            now = self.get_current_time()
+        if stamp is None:
+            stamp = now.strftime('%Y%m%d_%H%M%S')
         existing_snapshots = self.get_existing_snapshots()
-        current_year = now.strftime('%Y')
-        current_month = now.strftime('%Y%m')
-        current_day = now.strftime('%Y%m%d')
-        current_hour = now.strftime('%Y%m%d_%H')
-        
-        # Check if we need a yearly snapshot
-        if now.month == 1 and now.day == 1 and now.hour == 0 and now.minute == 0:
-            return 'YEAR'
-        # If no yearly snapshot exists for this year, create one
-        elif not any(snapshot[0:4] == current_year for snapshot in existing_snapshots.get('YEAR', [])):
-            return 'YEAR'
-            
-        # Check if we need a monthly snapshot
-        elif now.day == 1 and now.hour == 0 and now.minute == 0:
-            return 'MONTH'
-        # If no monthly snapshot exists for this month, create one
-        elif not any(snapshot[0:6] == current_month for snapshot in existing_snapshots.get('MONTH', [])):
-            return 'MONTH'
-            
-        # Check if we need a daily snapshot
-        elif now.hour == 0 and now.minute == 0:
-            return 'DAY'
-        # If no daily snapshot exists for this day, create one
-        elif not any(snapshot[0:8] == current_day for snapshot in existing_snapshots.get('DAY', [])):
-            return 'DAY'
-            
-        # Check if we need an hourly snapshot
-        elif now.minute == 0:
-            return 'HOUR'
-        # If no hourly snapshot exists for this hour, create one
-        elif not any(snapshot[0:11] == current_hour for snapshot in existing_snapshots.get('HOUR', [])):
-            return 'HOUR'
-            
-        # Default to minute
-        else:
-            return 'MINUTE'
+        current_year = stamp[_YEAR]
+        current_month = stamp[_MONTH]
+        current_day = stamp[_DAY]
+        current_hour = stamp[_HOUR]
+        
+        # Lists are sorted, so only the newest snapshot can cover the current period
+        latest = {t: snapshots[-1] for t, snapshots in existing_snapshots.items() if snapshots}
+        
+        # Period boundaries force a snapshot of that type even if one exists
+        start_of_hour = now.minute == 0
+        start_of_day = start_of_hour and now.hour == 0
+        start_of_month = start_of_day and now.day == 1
+        start_of_year = start_of_month and now.month == 1
+        
+        # Coarsest granularity that is due: 5=YEAR, 4=MONTH, 3=DAY, 2=HOUR, 1=MINUTE
+        granularity = (
+            5 if start_of_year or not latest.get('YEAR', '').startswith(current_year) else
+            4 if start_of_month or not latest.get('MONTH', '').startswith(current_month) else
+            3 if start_of_day or not latest.get('DAY', '').startswith(current_day) else
+            2 if start_of_hour or not latest.get('HOUR', '').startswith(current_hour) else
+            1
+        )
+        
+        # Coalesce bursts of changes into one MINUTE snapshot. A clock that
+        # stepped back (DST, NTP) counts as the interval having passed.
+        if granularity == 1 and (timedelta(0)
+                                 <= now - self._last_type_ts.get('MINUTE', datetime.min)
+                                 < self.min_minute_interval):
+            return None
+            
+        return self.snapshot_types[granularity - 1]
             
-    def create_snapshot(self, snapshot_type: str) -> str:
+    def create_snapshot(self, snapshot_type: str, now: Optional[datetime] = None,
+                        stamp: Optional[str] = None) -> str:
         """Create a new readonly snapshot"""
-        now = self.get_current_time()
-        timestamp = now.strftime('%Y%m%d_%H%M%S')
-        snapshot_name = f"{timestamp}_{snapshot_type}"
-        snapshot_path = os.path.join(self.snapshot_dir, snapshot_name)
+        if now is None:
+            now = self.get_current_time()
+        if stamp is None:
+            stamp = now.strftime('%Y%m%d_%H%M%S')
+        snapshot_name = f"{stamp}_{snapshot_type}"
+        snapshot_path = self._snap_prefix + snapshot_name
         
         try:
             if self.test_mode:
-                # In test mode, create an empty directory instead of a btrfs snapshot
-                Path(snapshot_path).mkdir(parents=True, exist_ok=True)
+                # In test mode, create an empty directory instead of a btrfs snapshot.
+                # ensure_directories() already created the parent.
+                try:
+                    os.mkdir(snapshot_path)
+                except FileExistsError:
+                    pass
                 self.logger.info(f"Created test snapshot (directory): {snapshot_name}")
             else:
-                # Create readonly snapshot
-                self.run_command([
-                    'btrfs', 'subvolume', 'snapshot', '-r',
-                    self.source_subvolume, snapshot_path
-                ])
-
-                #TODO: This is a hack to get the hash of the source subvolume after the snapshot is created
-                #That this is needed is a sign that has_changes() is not working as expected
+                # Create readonly snapshot. Snapshotting commits a transaction
+                # that bumps the source generation, so record the new value to
+                # avoid treating our own snapshot as a change.
+                if btrfsutil is not None:
+                    btrfsutil.create_snapshot(self.source_subvolume, snapshot_path, read_only=True)
+                else:
+                    self.run_command([
+                        'btrfs', 'subvolume', 'snapshot', '-r',
+                        self.source_subvolume, snapshot_path
+                    ])
                 self.last_snapshot_hash = self.get_subvolume_hash(self.source_subvolume)
             
+            cache = self._snapshots_cache
+            if cache is not None:
+                snapshots = cache[snapshot_type]
+                index = bisect.bisect_left(snapshots, snapshot_name)
+                if index == len(snapshots) or snapshots[index] != snapshot_name:
+                    snapshots.insert(index, snapshot_name)
+                self._refresh_snapshots_cache_mtime()
+            
+            self._last_type_ts[snapshot_type] = now
             self.logger.info(f"Created snapshot: {snapshot_name}")
             return snapshot_name
             
@@ -204,56 +442,189 @@ class BTRFSSnapshotMonitor:
             self.logger.error(f"Failed to create snapshot {snapshot_name}: {e}")
             raise
             
+    def _refresh_snapshots_cache_mtime(self):
+        """Record the snapshot directory mtime after we changed it ourselves"""
+        try:
+            self._snapshots_cache_mtime = os.stat(self.snapshot_dir).st_mtime_ns
+        except OSError:
+            self._snapshots_cache = None
+            self._snapshots_cache_mtime = None
+            
     def get_existing_snapshots(self) -> Dict[str, List[str]]:
-        """Get existing snapshots grouped by type"""
-        snapshots_by_type = {snapshot_type: [] for snapshot_type in self.snapshot_types}
+        """Get existing snapshots grouped by type, oldest first"""
+        try:
+            mtime = os.stat(self.snapshot_dir).st_mtime_ns
+        except OSError:
+            mtime = None
+            
+        # Reuse the previous listing if nothing else touched the directory
+        if (self._snapshots_cache is not None
+                and mtime is not None
+                and mtime == self._snapshots_cache_mtime):
+            return self._snapshots_cache
+            
+        snapshots_by_type = defaultdict(list)
         
         try:
             # List all directories in snapshot directory
-            for snapshot_name in os.listdir(self.snapshot_dir):
-                if '_' in snapshot_name:
-                    try:
-                        # Extract type from name (YYYYMMDD_HHMMSS_TYPE)
-                        type_part = snapshot_name.split('_')[-1]
-                        if type_part in self.snapshot_types:
-                            snapshots_by_type[type_part].append(snapshot_name)
-                    except IndexError:
-                        continue
+            match_name = self._snapshot_name_re.fullmatch
+            with os.scandir(self.snapshot_dir) as entries:
+                for entry in entries:
+                    snapshot_name = entry.name
+                    # Names that match have the type at a fixed offset
+                    if match_name(snapshot_name):
+                        snapshots_by_type[snapshot_name[_TYPE]].append(snapshot_name)
                                 
         except Exception as e:
             self.logger.error(f"Failed to list existing snapshots: {e}")
+            mtime = None
+            
+        # Snapshots queued for deletion are already gone as far as we care.
+        # The pending set only shrinks in reap_deletions() on this thread, so
+        # a name removed by a pool thread mid-scan is still filtered out.
+        pending = self._pending_deletes
+        for snapshots in snapshots_by_type.values():
+            if pending:
+                snapshots[:] = [name for name in snapshots if name not in pending]
+            snapshots.sort()
             
+        if self.logger.isEnabledFor(logging.DEBUG):
+            total = sum(len(snapshots) for snapshots in snapshots_by_type.values())
+            self.logger.debug("scanned %d snapshots across %d types", total, len(snapshots_by_type))
+            
+        # Only keep listings that were read completely
+        if mtime is None:
+            self._snapshots_cache = None
+        else:
+            self._snapshots_cache = snapshots_by_type
+        self._snapshots_cache_mtime = mtime
         return snapshots_by_type
         
+    def delete_snapshots(self, snapshot_names: List[str]) -> List[str]:
+        """Delete the given snapshots and return the names actually removed"""
+        if not self.test_mode and btrfsutil is None:
+            # The btrfs CLI accepts several subvolumes in one invocation;
+            # batches keep the argument list well below ARG_MAX
+            deleted = []
+            for start in range(0, len(snapshot_names), self.DELETE_BATCH_SIZE):
+                batch = snapshot_names[start:start + self.DELETE_BATCH_SIZE]
+                snapshot_paths = [self._snap_prefix + name for name in batch]
+                try:
+                    self.run_command(['btrfs', 'subvolume', 'delete', '--', *snapshot_paths])
+                    batch_deleted = batch
+                except Exception as e:
+                    self.logger.error(f"Failed to delete snapshots {', '.join(batch)}: {e}")
+                    # btrfs carries on past failures, so see which ones are gone
+                    batch_deleted = [name for name, path in zip(batch, snapshot_paths)
+                                     if not os.path.lexists(path)]
+                for snapshot_name in batch_deleted:
+                    self.logger.info(f"Deleted old snapshot: {snapshot_name}")
+                deleted.extend(batch_deleted)
+            return deleted
+            
+        deleted = []
+        for snapshot_name in snapshot_names:
+            snapshot_path = self._snap_prefix + snapshot_name
+            
+            try:
+                if self.test_mode:
+                    # In test mode, delete the directory; already gone is fine
+                    try:
+                        os.rmdir(snapshot_path)
+                    except FileNotFoundError:
+                        pass
+                    self.logger.info(f"Deleted old test snapshot (directory): {snapshot_name}")
+                else:
+                    # Delete the subvolume
+                    btrfsutil.delete_subvolume(snapshot_path)
+                    self.logger.info(f"Deleted old snapshot: {snapshot_name}")
+                deleted.append(snapshot_name)
+                
+            except Exception as e:
+                self.logger.error(f"Failed to delete snapshot {snapshot_name}: {e}")
+                
+        return deleted
+        
     def cleanup_old_snapshots(self, snapshot_type: str):
-        """Remove oldest snapshots if we exceed the limit"""
+        """Remove oldest snapshots if we exceed the limit
+        
+        The deletion runs on the background pool; this returns once it is
+        scheduled.
+        """
         existing_snapshots = self.get_existing_snapshots()
         snapshots = existing_snapshots.get(snapshot_type, [])
         
         if len(snapshots) >= self.max_snapshots_per_type:
-            # Sort snapshots by timestamp (oldest first)
-            snapshots.sort()
-            
             # Calculate how many to remove
             snapshots_to_remove = len(snapshots) - self.max_snapshots_per_type + 1
             
-            for i in range(snapshots_to_remove):
-                snapshot_name = snapshots[i]
-                snapshot_path = os.path.join(self.snapshot_dir, snapshot_name)
+            # The cached lists are kept sorted, so the oldest come first.
+            # Listings leave out snapshots already being deleted, so these are
+            # never scheduled twice.
+            victims = snapshots[:snapshots_to_remove]
+            self._pending_deletes.update(victims)
+            del snapshots[:snapshots_to_remove]
+            
+            # The directory itself is untouched until the pool gets to it, so
+            # the cached mtime stays valid
+            future = self._delete_pool.submit(self._delete_in_background, victims)
+            self._delete_futures[future] = victims
+            
+    def _delete_in_background(self, snapshot_names: List[str]) -> Tuple[List[str], Optional[int], Optional[int]]:
+        """Delete snapshots on a pool thread
+        
+        Returns the names removed along with the snapshot directory mtime
+        just before and just after, so reap_deletions() can tell whether
+        anything else changed the directory meanwhile.
+        """
+        mtime_before = self._snapshot_dir_mtime()
+        deleted = self.delete_snapshots(snapshot_names)
+        return deleted, mtime_before, self._snapshot_dir_mtime()
+        
+    def _snapshot_dir_mtime(self) -> Optional[int]:
+        """Return the snapshot directory mtime in ns, or None if it can't be read"""
+        try:
+            return os.stat(self.snapshot_dir).st_mtime_ns
+        except OSError:
+            return None
+            
+    def reap_deletions(self):
+        """Apply the results of finished background deletions
+        
+        Runs on the main thread at the start of each tick, so the snapshot
+        cache is never modified by pool threads.
+        """
+        finished = [future for future in self._delete_futures if future.done()]
+        if not finished:
+            return
+            
+        cache_valid = True
+        for future in finished:
+            victims = self._delete_futures.pop(future)
+            self._pending_deletes.difference_update(victims)
+            if future.exception() is not None or len(future.result()[0]) != len(victims):
+                # Some victims are still on disk; rescan so they are retried
+                cache_valid = False
                 
-                try:
-                    if self.test_mode:
-                        # In test mode, delete the directory
-                        if os.path.exists(snapshot_path):
-                            os.rmdir(snapshot_path)
-                        self.logger.info(f"Deleted old test snapshot (directory): {snapshot_name}")
-                    else:
-                        # Delete the subvolume
-                        self.run_command(['btrfs', 'subvolume', 'delete', snapshot_path])
-                        self.logger.info(f"Deleted old snapshot: {snapshot_name}")
-                    
-                except Exception as e:
-                    self.logger.error(f"Failed to delete snapshot {snapshot_name}: {e}")
+        if not cache_valid:
+            self._snapshots_cache = None
+            return
+            
+        # The cache already excludes the victims. Keep trusting it only if
+        # this deletion was the sole change to the directory: it started
+        # from the cached mtime and nothing has touched the directory since.
+        # Otherwise leave the old mtime so the next listing rescans.
+        if len(finished) == 1 and not self._delete_futures and self._snapshots_cache is not None:
+            _, mtime_before, mtime_after = finished[0].result()
+            if (mtime_before is not None
+                    and mtime_before == self._snapshots_cache_mtime
+                    and mtime_after == self._snapshot_dir_mtime()):
+                self._snapshots_cache_mtime = mtime_after
+            
+    def wait_for_deletions(self):
+        """Block until all scheduled snapshot deletions have finished"""
+        concurrent.futures.wait(list(self._delete_futures))
+        self.reap_deletions()
                     
     def monitor_loop(self):
         """Main monitoring loop"""
@@ -262,25 +633,44 @@ class BTRFSSnapshotMonitor:
         self.logger.info(f"Snapshot directory: {self.snapshot_dir}")
         self.logger.info(f"Check interval: {self.check_interval} seconds")
         
+        self.setup_inotify()
+        
+        if self.cpu_pin:
+            self.reduce_scheduling_impact()
+        
+        # Exit through SystemExit on SIGTERM so buffered log lines are written
+        signal.signal(signal.SIGTERM, self.handle_sigterm)
+        
         try:
             while True:
                 try:
+                    self.reap_deletions()
+                    
                     # Check for changes
                     if self.has_changes():
-                        # Determine snapshot type
-                        snapshot_type = self.get_snapshot_type()
+                        # Read the clock and format it once per tick
+                        now = self.get_current_time()
+                        stamp = now.strftime('%Y%m%d_%H%M%S')
                         
-                        # Create new snapshot
-                        snapshot_name = self.create_snapshot(snapshot_type)
+                        # Determine snapshot type
+                        snapshot_type = self.get_snapshot_type(now, stamp)
                         
-                        # Cleanup old snapshots of the same type
-                        self.cleanup_old_snapshots(snapshot_type)
+                        if snapshot_type is None:
+                            # Too soon after the last snapshot, retry next check
+                            self._change_deferred = True
+                        else:
+                            # Create new snapshot
+                            snapshot_name = self.create_snapshot(snapshot_type, now, stamp)
+                            
+                            # Cleanup old snapshots of the same type
+                            self.cleanup_old_snapshots(snapshot_type)
                         
                     # Wait for next check
-                    time.sleep(self.check_interval)
+                    self._events_seen = self.wait_for_next_check()
                     
                 except KeyboardInterrupt:
                     self.logger.info("Received interrupt signal, shutting down")
+                    self._delete_pool.shutdown(wait=True)
                     break
                 except Exception as e:
                     self.logger.error(f"Error in monitoring loop: {e}")
@@ -289,6 +679,141 @@ class BTRFSSnapshotMonitor:
         except Exception as e:
             self.logger.error(f"Fatal error: {e}")
             sys.exit(1)
+            
+    def reduce_scheduling_impact(self):
+        """Pin the monitor to one CPU, lower its priority and relax its timer slack
+        
+        On Linux these settings are per thread, and only threads started
+        afterwards (the deletion pool) inherit them. The log listener thread
+        already runs, so it is restarted once they are applied.
+        """
+        cpu = self.config.get('cpu_pin_cpu')
+        try:
+            if cpu is None:
+                cpu = max(os.sched_getaffinity(0))
+            os.sched_setaffinity(0, {cpu})
+            self.logger.info(f"Pinned to CPU {cpu}")
+        except OSError as e:
+            self.logger.warning(f"Failed to pin to CPU {cpu}: {e}")
+            
+        try:
+            os.nice(10)
+        except OSError as e:
+            self.logger.warning(f"Failed to lower priority: {e}")
+            
+        # Let the kernel coalesce our sleep wake-ups with other timers (1 ms)
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.prctl(PR_SET_TIMERSLACK, ctypes.c_ulong(1000000), 0, 0, 0) != 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        except (OSError, AttributeError) as e:
+            self.logger.warning(f"Failed to set timer slack: {e}")
+            
+        # stop() drains the queue first, so no records are lost
+        self._log_listener.stop()
+        self._log_listener.start()
+        
+    def handle_sigterm(self, signum, frame):
+        """Shut down cleanly when systemd stops the service"""
+        self.logger.info("Received SIGTERM, shutting down")
+        sys.exit(0)
+        
+    def setup_inotify(self):
+        """Watch the source subvolume tree for changes, if inotify_simple is available"""
+        if inotify_simple is None:
+            self.logger.info("inotify_simple not available, polling for changes")
+            return
+            
+        try:
+            self._inotify = inotify_simple.INotify()
+            self._epoll = select.epoll()
+            self._epoll.register(self._inotify.fileno(), select.EPOLLIN)
+        except OSError as e:
+            self.logger.warning(f"Failed to set up inotify, polling instead: {e}")
+            self._inotify = None
+            return
+            
+        # The kernel limit is per user and shared with systemd, udevd etc.,
+        # and every watch pins an inode in memory, so leave most of it alone
+        self._max_watches = self.config.get('max_watches')
+        if self._max_watches is None:
+            try:
+                with open('/proc/sys/fs/inotify/max_user_watches') as f:
+                    self._max_watches = int(f.read()) // 2
+            except (OSError, ValueError):
+                self._max_watches = 4096
+                
+        self.add_watches(self.source_subvolume)
+        self.logger.info(f"Watching {len(self._watch_paths)} directories for changes")
+        
+    def add_watches(self, top: str):
+        """Add inotify watches for top and every directory below it"""
+        if self._watches_exhausted:
+            return
+            
+        flags = inotify_simple.flags
+        mask = (flags.MODIFY | flags.CREATE | flags.DELETE | flags.MOVED_TO |
+                flags.MOVED_FROM | flags.ATTRIB)
+        
+        for dirpath, dirnames, _ in os.walk(top):
+            if len(self._watch_paths) >= self._max_watches:
+                # Timed checks still cover the rest
+                self.logger.warning(f"Reached max_watches ({self._max_watches}); "
+                                    f"not watching any further directories")
+                self._watches_exhausted = True
+                return
+            try:
+                wd = self._inotify.add_watch(dirpath, mask)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    # fs.inotify.max_user_watches; timed checks still cover the
+                    # rest. New directories would only fail the same way.
+                    self.logger.warning(f"Failed to watch {dirpath}: {e}; "
+                                        f"not watching any further directories")
+                    self._watches_exhausted = True
+                    return
+                self.logger.warning(f"Failed to watch {dirpath}: {e}")
+                continue
+            self._watch_paths[wd] = dirpath
+            
+    def handle_inotify_events(self, events) -> int:
+        """Track directories created or removed under the watched tree"""
+        flags = inotify_simple.flags
+        for event in events:
+            if event.mask & flags.IGNORED:
+                self._watch_paths.pop(event.wd, None)
+            elif event.mask & flags.ISDIR and event.mask & (flags.CREATE | flags.MOVED_TO):
+                parent = self._watch_paths.get(event.wd)
+                if parent is not None:
+                    self.add_watches(os.path.join(parent, event.name))
+        return len(events)
+        
+    def wait_for_next_check(self) -> bool:
+        """Sleep until the next check, waking early on inotify events
+        
+        Events are coalesced until none arrive for inotify_debounce seconds,
+        so a burst of writes leads to a single snapshot. check_interval caps
+        both the idle wait and the debounce.
+        
+        Returns True if events were seen; has_changes() treats that as a
+        change without consulting the subvolume generation.
+        """
+        if self._inotify is None:
+            time.sleep(self.check_interval)
+            return False
+            
+        if not self._epoll.poll(self.check_interval):
+            return False
+            
+        event_count = 0
+        deadline = time.monotonic() + self.check_interval
+        while True:
+            event_count += self.handle_inotify_events(self._inotify.read(timeout=0))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._epoll.poll(min(self.inotify_debounce, remaining)):
+                break
+        self.logger.debug(f"Woke on {event_count} inotify event(s)")
+        return True
     
     def run_test(self):
         """Run test mode with fake time to verify snapshot creation and cleanup"""
@@ -310,16 +835,19 @@ class BTRFSSnapshotMonitor:
         
         while current_time < end_time:
             self.fake_time = current_time
+            self.reap_deletions()
             
             # Check for changes and create snapshot if needed
             if self.has_changes():
-                snapshot_type = self.get_snapshot_type()
-                snapshot_name = self.create_snapshot(snapshot_type)
-                snapshots_created.append((snapshot_name, snapshot_type))
-                snapshot_count += 1
-                
-                # Cleanup old snapshots
-                self.cleanup_old_snapshots(snapshot_type)
+                stamp = current_time.strftime('%Y%m%d_%H%M%S')
+                snapshot_type = self.get_snapshot_type(current_time, stamp)
+                if snapshot_type is not None:
+                    snapshot_name = self.create_snapshot(snapshot_type, current_time, stamp)
+                    snapshots_created.append((snapshot_name, snapshot_type))
+                    snapshot_count += 1
+                    
+                    # Cleanup old snapshots
+                    self.cleanup_old_snapshots(snapshot_type)
             
             # Advance time
             current_time += time_step
@@ -333,6 +861,7 @@ class BTRFSSnapshotMonitor:
             type_counts[snapshot_type] = type_counts.get(snapshot_type, 0) + 1
         
         # Get final snapshot counts
+        self.wait_for_deletions()
         final_snapshots = self.get_existing_snapshots()
         final_counts = {snapshot_type: len(snapshots) for snapshot_type, snapshots in final_snapshots.items()}
         
@@ -407,6 +936,11 @@ def load_config(config_file: Optional[str] = None) -> Dict:
         'snapshot_dir': '/btrfs/snapshot',
         'check_interval': 300,  # 5 minutes
         'max_snapshots_per_type': 30,
+        'stat_precheck': False,
+        'min_minute_interval': 60,
+        'inotify_debounce': 5,
+        'delete_threads': 2,
+        'cpu_pin': False,
         'log_level': 'INFO',
         'log_file': '/var/log/btrfs_snapshot_monitor.log'
     }